@@ -1,8 +1,9 @@
 import asyncio
 import os
 import shutil
-from datetime import datetime, timedelta
+import time
 from app.config import config
+from app.logger import logger
 
 class AutoCleaner:
     def __init__(self):
@@ -20,22 +21,37 @@ class AutoCleaner:
             try:
                 await self._cleanup_old_files()
             except Exception as e:
-                print(f"Cleanup error: {e}")
+                logger.error("Cleanup error: %s", e)
     
     async def _cleanup_old_files(self):
-        now = datetime.now()
-        cutoff = now - timedelta(minutes=self.retention_minutes)
+        cutoff_ts = time.time() - self.retention_minutes * 60
         
-        for folder in [self.upload_dir, self.output_dir]:
-            if os.path.exists(folder):
-                for f in os.listdir(folder):
-                    fpath = os.path.join(folder, f)
-                    mtime = datetime.fromtimestamp(os.path.getmtime(fpath))
-                    if mtime < cutoff:
-                        if os.path.isfile(fpath):
-                            os.remove(fpath)
-                        elif os.path.isdir(fpath):
-                            shutil.rmtree(fpath)
-                        print(f"Pulito: {fpath}")
+        # La scansione è tutta I/O bloccante: la eseguiamo fuori dall'event loop
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._scan_and_delete, cutoff_ts)
+    
+    def _scan_and_delete(self, cutoff_ts):
+        # 1. Raccolta dei file scaduti (scandir: un solo stat per voce)
+        victims = []
+        for folder in [self.upload_dir, self.output_dir, config.TMPFS_OUTPUT_DIR]:
+            if folder and os.path.exists(folder):
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        try:
+                            if entry.stat(follow_symlinks=False).st_mtime < cutoff_ts:
+                                victims.append((entry.path, entry.is_dir(follow_symlinks=False)))
+                        except FileNotFoundError:
+                            continue  # rimosso tra readdir e stat dalla richiesta che lo aveva creato
+        
+        # 2. Eliminazione
+        for path, is_dir in victims:
+            try:
+                if is_dir:
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                continue  # già rimosso dalla richiesta che lo aveva creato
+            logger.info("Pulito: %s", path)
 
 auto_cleaner = AutoCleaner()
\ No newline at end of file
@@ -11,6 +11,14 @@ class Config:
     
     # Spleeter
     SPLEETER_MODEL = "spleeter:2stems"
+    SPLEETER_THREADS = 2  # thread TensorFlow per ogni worker del pool
+    SPLEETER_CODEC = "wav"  # stems in WAV 16 bit; "flac" per file circa dimezzati
+    
+    # Zip dei risultati
+    ZIP_DEFLATE_WAV = False  # True: comprime i WAV nello zip (DEFLATE livello 1)
+    
+    # Cache degli stems (per contenuto dell'audio)
+    STEM_CACHE_MAX_MB = 2000
     
     # Pulizia
     FILE_RETENTION_MINUTES = 30
@@ -20,5 +28,9 @@ class Config:
     UPLOAD_DIR = "uploads"
     OUTPUT_DIR = "outputs"
     LOG_DIR = "logs"
+    CACHE_DIR = "cache"
+    # Output Spleeter in RAM se c'è spazio ("" per disattivare). Usato solo se
+    # CACHE_DIR è sullo stesso filesystem (es. entrambe in /dev/shm)
+    TMPFS_OUTPUT_DIR = "/dev/shm/stems"
 
 config = Config()
\ No newline at end of file
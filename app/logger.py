@@ -0,0 +1,33 @@
+"""
+Logger dell'applicazione.
+I messaggi vengono messi in coda (QueueHandler) e scritti su stdout da un thread
+dedicato (QueueListener): gli handler delle richieste non attendono mai il lock di stdout.
+"""
+
+import atexit
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+logger = logging.getLogger("stem_splitter")
+
+def _setup_logger() -> QueueListener:
+    log_queue = queue.SimpleQueue()
+    
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    # Svuota la coda all'uscita del processo
+    atexit.register(listener.stop)
+    return listener
+
+_listener = _setup_logger()
+
+__all__ = ['logger']
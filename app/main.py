@@ -1,11 +1,14 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import psutil
 import uuid
 import os
 import shutil
 import time
 from datetime import datetime
+from typing import Optional
 
 # Import dei moduli interni
 from app.config import config
@@ -14,8 +17,11 @@ from app.storage_manager import storage_manager
 from app.auto_cleaner import auto_cleaner
 from app.resource_monitor import monitor
 from app.traffic_monitor import traffic_monitor
-from app.utils.file_utils import trim_audio, validate_audio_file
-from app.utils.spleeter_utils import separate_stems, create_zip
+from app.logger import logger
+from app.spleeter_pool import warm_up_pool, shutdown_pool
+from app.stem_cache import stem_cache
+from app.utils.file_utils import trim_audio_async, validate_audio_file
+from app.utils.spleeter_utils import separate_stems, aiter_zip, stem_files, zip_is_fresh
 
 # Inizializzazione app FastAPI
 app = FastAPI(
@@ -36,23 +42,40 @@ app.add_middleware(
 # ============================================
 # MIDDLEWARE DI PROTEZIONE RISORSE E TRAFFICO
 # ============================================
+# Endpoint pubblici (senza protezione)
+PUBLIC_ENDPOINTS = frozenset({
+    "/",
+    "/health",
+    "/docs",
+    "/openapi.json",
+    "/redoc",
+    "/admin/metrics",
+    "/admin/traffic"
+})
+
+# Dimensione massima del body di /separate: file + margine per l'involucro multipart
+MAX_UPLOAD_BODY_BYTES = config.MAX_FILE_SIZE_MB * 1024 * 1024 + 64 * 1024
+
 @app.middleware("http")
 async def resource_protection_middleware(request, call_next):
-    # Lista degli endpoint pubblici (senza protezione)
-    public_endpoints = [
-        "/", 
-        "/health", 
-        "/docs", 
-        "/openapi.json", 
-        "/redoc",
-        "/admin/metrics", 
-        "/admin/traffic"
-    ]
+    path = request.url.path
     
     # Se è un endpoint pubblico, passa direttamente
-    if request.url.path in public_endpoints:
+    if path in PUBLIC_ENDPOINTS:
         return await call_next(request)
     
+    # 0. Rifiuta subito gli upload dichiarati troppo grandi, prima che il body venga letto
+    if path == "/separate":
+        content_length = request.headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > MAX_UPLOAD_BODY_BYTES:
+            return JSONResponse(
+                status_code=413,
+                content={
+                    "error": "File too large",
+                    "max_file_size_mb": config.MAX_FILE_SIZE_MB
+                }
+            )
+    
     # 1. Controllo risorse di sistema (RAM/CPU)
     ok, message = resource_guard.check_resources()
     if not ok:
@@ -100,24 +123,24 @@ async def root():
         "documentation": "/docs"
     }
 
+# Cache della RAM usata: [istante monotonic, MB]
+_ram_cache = [float('-inf'), 0]
+
+def _cached_ram_mb(ttl=1.0):
+    """RAM usata in MB, letta da psutil al massimo una volta ogni ttl secondi"""
+    now = time.monotonic()
+    if now - _ram_cache[0] > ttl:
+        _ram_cache[1] = psutil.virtual_memory().used >> 20
+        _ram_cache[0] = now
+    return _ram_cache[1]
+
 # ============================================
 # ENDPOINT: HEALTH CHECK
 # ============================================
 @app.get("/health")
 async def health():
     """Health check per monitoraggio"""
-    # Calcola RAM in modo sicuro
-    ram_mb = 0
-    try:
-        # Se resource_guard ha un metodo per ottenere RAM, usalo
-        if hasattr(resource_guard, 'get_current_ram_mb'):
-            ram_mb = resource_guard.get_current_ram_mb()
-        else:
-            # Altrimenti usa psutil direttamente
-            import psutil
-            ram_mb = psutil.virtual_memory().used / (1024 * 1024)
-    except:
-        pass  # Se fallisce, lascia 0
+    ram_mb = _cached_ram_mb()
     
     return {
         "status": "healthy",
@@ -130,98 +153,143 @@ async def health():
 # ============================================
 # ENDPOINT: SEPARAZIONE AUDIO
 # ============================================
+async def _account_streamed_zip(chunks, upload_size, file_id):
+    """Inoltra i blocchi dello zip e registra il traffico a invio terminato (anche se interrotto)."""
+    zip_size = 0
+    try:
+        async for chunk in chunks:
+            zip_size += len(chunk)
+            yield chunk
+    finally:
+        await chunks.aclose()
+        traffic_monitor.add_traffic(upload_size, zip_size)
+        logger.info("✅ Richiesta %s completata. Upload: %.1fKB, Download: %.1fKB",
+                    file_id, upload_size / 1024, zip_size / 1024)
+
 @app.post("/separate")
-async def separate_audio(file: UploadFile = File(...)):
+async def separate_audio(file: UploadFile = File(...), stems: Optional[str] = Form(None)):
     """
     Endpoint principale per la separazione delle tracce audio.
     - Accetta un file audio
     - Valida dimensioni e formato
     - Separa in stems (voce, batteria, basso, altri)
-    - Restituisce uno zip con tutti i file
+    - Restituisce uno zip con tutti i file, oppure solo gli stems indicati
+      in `stems` (nomi separati da virgola; con uno solo, il file senza zip)
     """
+    # Valore vuoto o solo separatori (" ", ","): come nessuna selezione
+    requested = [name.strip() for name in (stems or "").split(",") if name.strip()] or None
+    
     # === CONTEXT MANAGER PER RICHIESTE CONCORRENTI ===
     with resource_guard:
         
         # === 1. VALIDAZIONI PRELIMINARI ===
         validate_audio_file(file.filename)
         
-        # === 2. LETTURA FILE E CALCOLO DIMENSIONI ===
-        try:
-            file_content = await file.read()
-            upload_size = len(file_content)
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Errore nella lettura del file: {str(e)}")
-        
-        if upload_size == 0:
-            raise HTTPException(status_code=400, detail="Il file è vuoto")
-        
-        # === 3. PREPARAZIONE ID E PATH ===
+        # === 2. PREPARAZIONE ID E PATH ===
         file_id = str(uuid.uuid4())
         input_path = None
         trimmed_path = None
-        zip_path = None
+        output_folder = None
         stem_folder = None
         
         try:
-            # === 4. SALVATAGGIO FILE ORIGINALE ===
-            input_path = await storage_manager.safe_save_upload_bytes(
-                file_content=file_content,
-                original_filename=file.filename,
-                file_id=file_id
-            )
+            # === 3. SALVATAGGIO FILE ORIGINALE (a blocchi, senza caricarlo in RAM) ===
+            input_path, upload_size = await storage_manager.safe_save_upload(file, file_id)
+            
+            # === 4. CONTROLLO FILE VUOTO ===
+            if upload_size == 0:
+                raise HTTPException(status_code=400, detail="Il file è vuoto")
             
-            # === 5. TAGLIO A DURATA MASSIMA ===
+            # === 5. TAGLIO A DURATA MASSIMA E CONVERSIONE A 44.1 kHz STEREO ===
             trimmed_path = os.path.join(
                 config.UPLOAD_DIR, 
-                f"{file_id}_trimmed.mp3"
+                f"{file_id}_trimmed.wav"
             )
-            trim_audio(input_path, trimmed_path, config.MAX_FILE_DURATION_SEC)
+            await trim_audio_async(input_path, trimmed_path, config.MAX_FILE_DURATION_SEC)
             
             # === 6. PREPARAZIONE OUTPUT ===
-            output_folder = os.path.join(config.OUTPUT_DIR, file_id)
-            os.makedirs(output_folder, exist_ok=True)
+            output_folder = storage_manager.output_folder_for(file_id)
             
             # === 7. SEPARAZIONE SPLEETER ===
-            stem_folder = separate_stems(
+            stem_folder = await separate_stems(
                 input_path=trimmed_path, 
                 output_folder=output_folder, 
                 file_id=file_id
             )
             
-            # === 8. CREAZIONE ZIP ===
-            zip_path = os.path.join(config.OUTPUT_DIR, f"{file_id}.zip")
-            create_zip(stem_folder, zip_path)
-            zip_size = os.path.getsize(zip_path)
+            # === 8. SELEZIONE STEMS E ZIP GIÀ PRONTO IN CACHE? ===
+            loop = asyncio.get_running_loop()
+            if requested is not None:
+                available = await loop.run_in_executor(None, stem_files, stem_folder)
+                unknown = [name for name in requested if name not in available]
+                if unknown:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Stems non disponibili: {', '.join(unknown)}. Disponibili: {', '.join(sorted(available))}"
+                    )
+                requested = list(dict.fromkeys(requested))
+                if set(requested) == set(available):
+                    requested = None  # tutti gli stems: come nessuna selezione
+            
+            zip_path = stem_cache.zip_path(stem_folder)
+            zip_ready = requested is None and await loop.run_in_executor(
+                None, zip_is_fresh, stem_folder, zip_path
+            )
             
             # === 9. PULIZIA FILE INTERMEDI ===
             if os.path.exists(trimmed_path):
                 os.remove(trimmed_path)
             if os.path.exists(input_path):
                 os.remove(input_path)
-            if stem_folder and os.path.exists(stem_folder):
-                shutil.rmtree(stem_folder)
             
             # === 10. AGGIORNAMENTO METRICHE ===
             monitor.metrics['requests_count'] += 1
-            traffic_monitor.add_traffic(upload_size, zip_size)
+            headers = {
+                "X-Traffic-Usage": f"{traffic_monitor.get_usage_percent():.1f}%",
+                "X-Request-ID": file_id
+            }
+            
+            # === 11. INVIO RISULTATO ===
+            if requested is not None and len(requested) == 1:
+                # Un solo stem: il file direttamente, senza zip
+                stem_path = available[requested[0]]
+                download_size = os.path.getsize(stem_path)
+                traffic_monitor.add_traffic(upload_size, download_size)
+                logger.info("✅ Richiesta %s completata. Upload: %.1fKB, Download: %.1fKB",
+                            file_id, upload_size / 1024, download_size / 1024)
+                return FileResponse(
+                    stem_path,
+                    filename=os.path.basename(stem_path),
+                    headers=headers
+                )
             
-            print(f"✅ Richiesta {file_id} completata. Upload: {upload_size/1024:.1f}KB, Download: {zip_size/1024:.1f}KB")
+            if zip_ready:
+                # Lo zip resta nella cache degli stems (eliminato dall'eviction della cache)
+                zip_size = os.path.getsize(zip_path)
+                traffic_monitor.add_traffic(upload_size, zip_size)
+                logger.info("✅ Richiesta %s completata. Upload: %.1fKB, Download: %.1fKB",
+                            file_id, upload_size / 1024, zip_size / 1024)
+                return FileResponse(
+                    zip_path, 
+                    filename="stems.zip",
+                    media_type="application/zip",
+                    headers=headers
+                )
             
-            # === 11. INVIO ZIP ===
-            return FileResponse(
-                zip_path, 
-                filename="stems.zip",
+            # Zip generato mentre viene inviato; se contiene tutti gli stems viene
+            # salvato in cache nello stesso passaggio
+            headers["Content-Disposition"] = 'attachment; filename="stems.zip"'
+            chunks = aiter_zip(stem_folder, tee_path=zip_path if requested is None else None, stems=requested)
+            return StreamingResponse(
+                _account_streamed_zip(chunks, upload_size, file_id),
                 media_type="application/zip",
-                headers={
-                    "X-Traffic-Usage": f"{traffic_monitor.get_usage_percent():.1f}%",
-                    "X-Request-ID": file_id
-                }
+                headers=headers
             )
             
         except HTTPException:
             raise
         except Exception as e:
-            print(f"❌ Errore nella richiesta {file_id}: {str(e)}")
+            logger.error("❌ Errore nella richiesta %s: %s", file_id, e)
             raise HTTPException(
                 status_code=500, 
                 detail=f"Errore durante l'elaborazione: {str(e)}"
@@ -229,13 +297,17 @@ async def separate_audio(file: UploadFile = File(...)):
             
         finally:
             # === 12. PULIZIA DI EMERGENZA ===
-            # Rimuovi solo i file che non sono lo zip (lo zip verrà pulito dopo l'invio)
+            # Rimuovi solo i file della richiesta (lo zip appartiene alla cache degli stems)
             for file_path in [input_path, trimmed_path]:
                 if file_path and os.path.exists(file_path):
                     try:
                         os.remove(file_path)
                     except Exception as e:
-                        print(f"⚠️ Errore nella pulizia di {file_path}: {e}")
+                        logger.warning("⚠️ Errore nella pulizia di %s: %s", file_path, e)
+            # Cartella di output della richiesta (può stare su tmpfs: non va lasciata
+            # all'auto_cleaner). stem_folder invece è nella cache degli stems e resta.
+            if output_folder:
+                shutil.rmtree(output_folder, ignore_errors=True)
 
 # ============================================
 # ENDPOINT: METRICHE DI SISTEMA
@@ -243,16 +315,7 @@ async def separate_audio(file: UploadFile = File(...)):
 @app.get("/admin/metrics")
 async def get_metrics():
     """Metriche dettagliate del sistema (solo per admin)"""
-    # Calcola RAM in modo sicuro
-    ram_mb = 0
-    try:
-        if hasattr(resource_guard, 'get_current_ram_mb'):
-            ram_mb = resource_guard.get_current_ram_mb()
-        else:
-            import psutil
-            ram_mb = psutil.virtual_memory().used / (1024 * 1024)
-    except:
-        pass
+    ram_mb = _cached_ram_mb()
     
     return {
         "current": {
@@ -260,7 +323,7 @@ async def get_metrics():
             "concurrent_requests": resource_guard.current_requests,
             "storage_mb": storage_manager.get_current_usage()
         },
-        "history": monitor.metrics,
+        "history": monitor.get_history(),
         "limits": {
             "max_ram_mb": resource_guard.max_ram_mb,
             "max_storage_mb": resource_guard.max_storage_mb,
@@ -295,14 +358,17 @@ async def startup_event():
     # Avvia cleaner automatico
     await auto_cleaner.start()
     
-    # Crea directory necessarie
-    os.makedirs(config.UPLOAD_DIR, exist_ok=True)
-    os.makedirs(config.OUTPUT_DIR, exist_ok=True)
-    os.makedirs(config.LOG_DIR, exist_ok=True)
+    # Avvia i worker Spleeter (caricano il modello in background)
+    warm_up_pool()
+    
+    # Crea la directory dei log (upload e output sono già creati da storage_manager)
+    if not os.path.isdir(config.LOG_DIR):
+        os.makedirs(config.LOG_DIR, exist_ok=True)
     
-    print(f"🚀 Stem Splitter API avviata - PID: {os.getpid()}")
-    print(f"📊 Limiti: File max {config.MAX_FILE_SIZE_MB}MB, Durata max {config.MAX_DURATION_SEC}s, Modello {config.SPLEETER_MODEL}")
-    print(f"📈 Traffico mensile: 10GB (attuale: {traffic_monitor.used_bytes/(1024**3):.2f}GB)")
+    logger.info("🚀 Stem Splitter API avviata - PID: %d", os.getpid())
+    logger.info("📊 Limiti: File max %dMB, Durata max %ds, Modello %s",
+                config.MAX_FILE_SIZE_MB, config.MAX_FILE_DURATION_SEC, config.SPLEETER_MODEL)
+    logger.info("📈 Traffico mensile: 10GB (attuale: %.2fGB)", traffic_monitor.used_bytes / (1024**3))
 
 # ============================================
 # SHUTDOWN EVENT
@@ -312,7 +378,9 @@ async def shutdown_event():
     """
     Operazioni allo spegnimento dell'applicazione
     """
-    print("🛑 Stem Splitter API in arresto...")
+    logger.info("🛑 Stem Splitter API in arresto...")
+    # Ferma i worker Spleeter
+    shutdown_pool()
     # Salva stato traffico
     traffic_monitor.save_state()
-    print("✅ Stato salvato")
+    logger.info("✅ Stato salvato")
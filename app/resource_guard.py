@@ -1,5 +1,4 @@
 import psutil
-import threading
 from app.config import config
 
 class ResourceGuard:
@@ -7,11 +6,19 @@ class ResourceGuard:
         self.max_ram_mb = config.MAX_RAM_MB
         self.max_cpu_percent = config.MAX_CPU_PERCENT
         self.max_storage_mb = config.MAX_STORAGE_MB
+        # Modificato solo dal thread dell'event loop: nessun lock necessario
         self.current_requests = 0
-        self.lock = threading.Lock()
+    
+    def __enter__(self):
+        self.current_requests += 1
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.current_requests -= 1
+        return False
     
     def check_resources(self):
         # ... (codice dal messaggio precedente)
         pass
 
-resource_guard = ResourceGuard()
\ No newline at end of file
+resource_guard = ResourceGuard()
@@ -1,43 +1,31 @@
 import logging
 import psutil
-import time
-from typing import Dict
+from collections import deque
+from typing import Dict, Union
 from app.storage_manager import storage_manager
 
+# Campioni conservati per serie: 24 ore a un campione al minuto
+METRICS_HISTORY_LEN = 1440
+
 class ResourceMonitor:
     def __init__(self):
-        self.metrics: Dict[str, list] = {
-            'ram_usage': [],
-            'cpu_usage': [],
-            'storage_usage': [],
+        self.metrics: Dict[str, Union[deque, int]] = {
+            'ram_usage': deque(maxlen=METRICS_HISTORY_LEN),
+            'cpu_usage': deque(maxlen=METRICS_HISTORY_LEN),
+            'storage_usage': deque(maxlen=METRICS_HISTORY_LEN),
             'requests_count': 0
         }
         self.logger = logging.getLogger(__name__)
+    
+    def get_history(self) -> dict:
+        """Copia delle metriche con le serie convertite in liste (per le risposte JSON)"""
+        return {
+            key: list(value) if isinstance(value, deque) else value
+            for key, value in self.metrics.items()
+        }
         
     def log_metrics(self):
         # ... (codice dal messaggio precedente)
         pass
 
-class TrafficMonitor:
-    def __init__(self, max_gb_per_month=10):
-        self.max_bytes = max_gb_per_month * 1024 * 1024 * 1024  # 10 GB in bytes
-        self.used_bytes = 0
-        self.month_start = time.time()
-        # In un'implementazione reale, dovresti salvare questi dati su disco/db
-        
-    def add_traffic(self, upload_bytes, download_bytes):
-        """Aggiunge traffico e controlla se si supera il limite"""
-        self.used_bytes += (upload_bytes + download_bytes)
-        
-        # Se superiamo il 90% del limite, logga un avviso
-        if self.used_bytes > self.max_bytes * 0.9:
-            print(f"⚠️ ATTENZIONE: Traffico al {self.used_bytes/self.max_bytes*100:.1f}% del limite mensile")
-            
-    def is_limit_reached(self):
-        """Restituisce True se abbiamo superato il limite"""
-        return self.used_bytes >= self.max_bytes
-
-    def get_usage_percent(self):
-        return (self.used_bytes / self.max_bytes) * 100
-
 monitor = ResourceMonitor()
@@ -0,0 +1,101 @@
+"""
+Pool di processi con il modello Spleeter già caricato.
+Ogni worker crea il proprio Separator all'avvio (initializer) e lo riusa per tutte
+le richieste: TensorFlow non è thread-safe e il caricamento del modello costa
+diversi secondi, quindi lo paghiamo una sola volta per processo.
+"""
+
+import asyncio
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app.config import config
+
+# Separator del processo worker e formato degli stems (valorizzati da _load_model)
+_separator = None
+_codec = None
+
+def _gpu_available():
+    """True se il worker può usare una GPU NVIDIA (driver presente e non disabilitata)."""
+    if os.environ.get("CUDA_VISIBLE_DEVICES", None) in ("", "-1"):
+        return False
+    return shutil.which("nvidia-smi") is not None
+
+def _load_model():
+    """Initializer dei worker: carica il modello e lo scalda con un secondo di silenzio."""
+    global _separator, _codec
+    
+    # Con GPU: TensorFlow la usa da solo, ma senza allow_growth il primo worker
+    # riserva tutta la memoria e gli altri falliscono. Va impostato prima dell'import.
+    if _gpu_available():
+        os.environ.setdefault("TF_FORCE_GPU_ALLOW_GROWTH", "true")
+    
+    import numpy as np
+    import tensorflow as tf
+    from spleeter.audio import Codec
+    from spleeter.separator import Separator
+    
+    # Senza limite ogni worker usa tutti i core e i worker si rubano la CPU a vicenda
+    tf.config.threading.set_intra_op_parallelism_threads(config.SPLEETER_THREADS)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    
+    # multiprocess=False: i worker del pool sono daemon e non possono creare figli
+    _separator = Separator(config.SPLEETER_MODEL, multiprocess=False)
+    _separator.separate(np.zeros((44100, 2), dtype=np.float32))
+    _codec = Codec(config.SPLEETER_CODEC)
+
+def _run_sep(input_path, output_folder):
+    """Eseguito nel worker: separa input_path e restituisce la cartella degli stems."""
+    # Con codec WAV ffmpeg scrive PCM 16 bit: metà dei byte rispetto ai float32 del modello
+    _separator.separate_to_file(input_path, output_folder, codec=_codec, synchronous=True)
+    # I file in ingresso hanno sempre un'estensione; os.stat solleva se Spleeter
+    # non ha prodotto la cartella, così l'errore risale al chiamante
+    base_name = os.path.basename(input_path).rpartition('.')[0]
+    stem_folder = os.path.join(output_folder, base_name)
+    os.stat(stem_folder)
+    return stem_folder
+
+def _ping():
+    return os.getpid()
+
+# Un worker per richiesta concorrente, ma mai più dei core disponibili:
+# ogni worker tiene in RAM il proprio modello
+POOL_SIZE = max(1, min(os.cpu_count() or 1, config.MAX_CONCURRENT_REQUESTS))
+
+def _create_pool():
+    return ProcessPoolExecutor(
+        max_workers=POOL_SIZE,
+        initializer=_load_model
+    )
+
+spleeter_pool = _create_pool()
+
+def warm_up_pool():
+    """Avvia subito tutti i worker così il modello è caldo prima della prima richiesta."""
+    for _ in range(POOL_SIZE):
+        spleeter_pool.submit(_ping)
+
+async def run_separation(input_path, output_folder, timeout=None):
+    """
+    Esegue la separazione su un worker del pool senza bloccare l'event loop.
+    Un job ancora in coda viene annullato allo scadere di timeout; uno già avviato
+    non si può interrompere, quindi la sua cartella di output viene eliminata
+    quando termina (il chiamante ha già rinunciato al risultato).
+    """
+    global spleeter_pool
+    try:
+        future = spleeter_pool.submit(_run_sep, input_path, output_folder)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            future.add_done_callback(lambda _: shutil.rmtree(output_folder, ignore_errors=True))
+            raise
+    except BrokenProcessPool:
+        # Un worker è morto (es. OOM): ricrea il pool per le richieste successive
+        spleeter_pool.shutdown(wait=False)
+        spleeter_pool = _create_pool()
+        raise
+
+def shutdown_pool():
+    spleeter_pool.shutdown(wait=False)
@@ -0,0 +1,160 @@
+"""
+Cache degli stems indicizzata per contenuto.
+La chiave è lo SHA-256 dell'audio passato a Spleeter insieme a modello e codec
+configurati: se lo stesso file viene caricato di nuovo, gli stems già calcolati
+vengono riusati senza rieseguire il modello.
+Ogni voce è la cartella CACHE_DIR/<hash>, quindi l'indice sopravvive ai riavvii;
+la data di modifica della cartella fa da ordine LRU per l'eviction.
+Accanto a ogni cartella può esserci lo zip già pronto (CACHE_DIR/<hash>.zip, o
+<hash>.deflate.zip se ZIP_DEFLATE_WAV è attivo).
+"""
+
+import hashlib
+import os
+import shutil
+import time
+import uuid
+from typing import Dict, Optional
+from app.config import config
+from app.logger import logger
+
+# Dimensione dei blocchi letti per calcolare l'hash (1 MB)
+HASH_CHUNK_SIZE = 1 << 20
+
+# Suffisso delle copie in corso dentro CACHE_DIR (rinominate solo se complete)
+TMP_SUFFIX = ".tmp"
+# Età oltre la quale una copia temporanea è considerata abbandonata: con più
+# worker uvicorn quelle più recenti possono essere ancora in scrittura
+TMP_MAX_AGE_SEC = 3600
+
+# Suffisso dello zip in cache per modalità di compressione (ZIP_DEFLATE_WAV
+# False/True): cambiando impostazione gli zip dell'altra modalità non vengono serviti
+ZIP_SUFFIXES = (".zip", ".deflate.zip")
+
+class StemCache:
+    def __init__(self):
+        self.cache_dir = config.CACHE_DIR
+        self.max_bytes = config.STEM_CACHE_MAX_MB * 1024 * 1024
+        self._entries: Dict[str, str] = {}  # hash -> cartella degli stems
+        
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+    
+    def _load_index(self) -> None:
+        """
+        Ricostruisce l'indice dalle cartelle presenti in CACHE_DIR.
+        Le copie temporanee (cartelle e zip) rimaste da un processo interrotto
+        vengono eliminate se più vecchie di TMP_MAX_AGE_SEC.
+        """
+        cutoff_ts = time.time() - TMP_MAX_AGE_SEC
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if not entry.name.endswith(TMP_SUFFIX):
+                        if is_dir:
+                            self._entries[entry.name] = entry.path
+                    elif entry.stat(follow_symlinks=False).st_mtime < cutoff_ts:
+                        if is_dir:
+                            shutil.rmtree(entry.path, ignore_errors=True)
+                        else:
+                            os.remove(entry.path)
+                except FileNotFoundError:
+                    continue  # completata o rimossa da un altro worker
+    
+    @staticmethod
+    def hash_file(path: str) -> str:
+        """
+        SHA-256 del file, letto a blocchi per non caricarlo tutto in RAM.
+        Include modello e codec: cambiando configurazione i risultati vecchi non vengono riusati.
+        """
+        digest = hashlib.sha256(f"{config.SPLEETER_MODEL}|{config.SPLEETER_CODEC}|".encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def zip_path(stem_folder: str) -> str:
+        """Path dello zip in cache associato a una cartella di stems."""
+        return f"{stem_folder.rstrip(os.sep)}{ZIP_SUFFIXES[bool(config.ZIP_DEFLATE_WAV)]}"
+    
+    def get(self, key: str) -> Optional[str]:
+        """Cartella degli stems per key, o None se non in cache."""
+        folder = self._entries.get(key)
+        if folder is None:
+            # Con più worker uvicorn la voce può essere stata aggiunta da un altro processo
+            folder = os.path.join(self.cache_dir, key)
+            if not os.path.isdir(folder):
+                return None
+            self._entries[key] = folder
+        try:
+            os.utime(folder)  # segna come usata di recente (LRU)
+        except FileNotFoundError:
+            self._entries.pop(key, None)
+            return None
+        return folder
+    
+    def put(self, key: str, stem_folder: str) -> str:
+        """
+        Sposta stem_folder nella cache sotto key e applica il limite di spazio.
+        
+        Returns:
+            Path della cartella in cache
+        """
+        dest = os.path.join(self.cache_dir, key)
+        if os.path.isdir(dest):
+            # Stesso audio completato da un'altra richiesta nel frattempo
+            shutil.rmtree(stem_folder, ignore_errors=True)
+        else:
+            # Stesso filesystem: semplice rename. Altrimenti (es. output su tmpfs)
+            # copyfile, che su Linux usa os.sendfile (copia nel kernel) e salta la
+            # copia dei metadati di copy2. La copia va in una cartella temporanea
+            # rinominata solo a fine copia: un errore a metà non lascia voci parziali
+            tmp_dest = os.path.join(self.cache_dir, f"{key}.{uuid.uuid4().hex}{TMP_SUFFIX}")
+            try:
+                shutil.move(stem_folder, tmp_dest, copy_function=shutil.copyfile)
+                os.rename(tmp_dest, dest)
+            except OSError:
+                shutil.rmtree(tmp_dest, ignore_errors=True)
+                if not os.path.isdir(dest):
+                    raise
+                # dest creata nel frattempo da un'altra richiesta: si usa quella
+        self._entries[key] = dest
+        self._evict(keep=key)
+        return dest
+    
+    def _evict(self, keep: str) -> None:
+        """Elimina le voci usate meno di recente finché la cache supera max_bytes."""
+        sizes = []
+        total = 0
+        for key, folder in list(self._entries.items()):
+            try:
+                mtime = os.stat(folder).st_mtime
+                size = sum(e.stat().st_size for e in os.scandir(folder) if e.is_file())
+                for suffix in ZIP_SUFFIXES:
+                    if os.path.exists(folder + suffix):
+                        size += os.path.getsize(folder + suffix)
+            except FileNotFoundError:
+                self._entries.pop(key, None)
+                continue
+            sizes.append((mtime, key, folder, size))
+            total += size
+        
+        for _, key, folder, size in sorted(sizes):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(folder, ignore_errors=True)
+            for suffix in ZIP_SUFFIXES:
+                try:
+                    os.remove(folder + suffix)
+                except FileNotFoundError:
+                    pass
+            self._entries.pop(key, None)
+            total -= size
+            logger.info("Stem cache: rimossa voce %s", key)
+
+stem_cache = StemCache()
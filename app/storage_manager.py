@@ -1,11 +1,25 @@
+import asyncio
 import os
+import re
 import time
-import aiofiles
 import shutil
 from pathlib import Path
 from fastapi import HTTPException
 from app.config import config
 
+# Dimensione dei blocchi letti dall'upload (1 MB)
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Validità (secondi) del valore calcolato da get_current_usage
+USAGE_CACHE_TTL_SEC = 5.0
+
+def _stems_size_estimate():
+    """Stima per eccesso dei byte scritti da Spleeter per un file di durata massima."""
+    # Numero davanti a "stems" (es. "spleeter:4stems-16kHz" -> 4)
+    match = re.search(r'(\d+)stems', config.SPLEETER_MODEL)
+    stems = int(match.group(1)) if match else 5
+    # 44.1kHz, stereo, PCM 16 bit (FLAC è più piccolo)
+    return config.MAX_FILE_DURATION_SEC * 44100 * 2 * 2 * stems
+
 class StorageManager:
     def __init__(self):
         self.max_total_mb = config.MAX_STORAGE_MB
@@ -13,21 +27,120 @@ class StorageManager:
         self.max_duration_sec = config.MAX_FILE_DURATION_SEC
         self.upload_dir = config.UPLOAD_DIR
         self.output_dir = config.OUTPUT_DIR
+        self._usage_cache = (float('-inf'), 0.0)  # (istante monotonic, MB)
         
         # Crea le directory se non esistono
-        os.makedirs(self.upload_dir, exist_ok=True)
-        os.makedirs(self.output_dir, exist_ok=True)
+        for folder in (self.upload_dir, self.output_dir):
+            if not os.path.isdir(folder):
+                os.makedirs(folder, exist_ok=True)
     
     async def safe_save_upload(self, file, file_id):
-        # ... (codice dal messaggio precedente)
-        pass
+        """
+        Salva l'upload su disco a blocchi, senza tenerlo interamente in RAM.
+        
+        Returns:
+            Tupla (path del file salvato, byte scritti)
+        """
+        ext = os.path.splitext(file.filename or "")[1].lower()
+        path = os.path.join(self.upload_dir, f"{file_id}{ext}")
+        max_bytes = self.max_file_mb * 1024 * 1024
+        
+        # Un solo passaggio nel thread pool per l'intera copia, invece di un salto
+        # per ogni lettura e ogni scrittura di blocco
+        loop = asyncio.get_running_loop()
+        try:
+            upload_size = await loop.run_in_executor(
+                None, self._copy_upload, file.file, path, max_bytes
+            )
+        except HTTPException:
+            self._remove_quietly(path)
+            raise
+        except Exception as e:
+            self._remove_quietly(path)
+            raise HTTPException(status_code=400, detail=f"Errore nella lettura del file: {str(e)}")
+        
+        return path, upload_size
+    
+    def output_folder_for(self, file_id):
+        """
+        Cartella di output di Spleeter per la richiesta.
+        Usa TMPFS_OUTPUT_DIR (RAM) se ha spazio per gli stems ed è sullo stesso
+        filesystem di CACHE_DIR, altrimenti OUTPUT_DIR.
+        """
+        folder = os.path.join(self.output_dir, file_id)
+        tmpfs_dir = config.TMPFS_OUTPUT_DIR
+        if tmpfs_dir:
+            try:
+                if not os.path.isdir(tmpfs_dir):
+                    os.makedirs(tmpfs_dir, exist_ok=True)
+                # Gli stems finiscono comunque nella cache: su un altro filesystem
+                # lo spostamento diventerebbe una copia completa invece di un rename
+                same_fs = os.stat(tmpfs_dir).st_dev == os.stat(config.CACHE_DIR).st_dev
+                if same_fs and shutil.disk_usage(tmpfs_dir).free >= _stems_size_estimate():
+                    folder = os.path.join(tmpfs_dir, file_id)
+            except OSError:
+                pass  # tmpfs non disponibile (es. non Linux): resta su disco
+        os.makedirs(folder, exist_ok=True)
+        return folder
+    
+    def _copy_upload(self, src, path, max_bytes):
+        """Copia (bloccante) del file temporaneo dell'upload verso path."""
+        src.seek(0)
+        upload_size = 0
+        with open(path, 'wb') as dst:
+            while True:
+                chunk = src.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                upload_size += len(chunk)
+                if upload_size > max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"File troppo grande (max {self.max_file_mb}MB)"
+                    )
+                dst.write(chunk)
+        return upload_size
+    
+    @staticmethod
+    def _remove_quietly(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
     
     async def emergency_cleanup(self):
         # ... (codice dal messaggio precedente)
         pass
     
     def get_current_usage(self):
-        # ... (codice dal messaggio precedente)
-        pass
+        """
+        Spazio occupato da upload, output e cache degli stems, in MB.
+        Il valore viene ricalcolato al massimo ogni USAGE_CACHE_TTL_SEC secondi.
+        """
+        now = time.monotonic()
+        if now - self._usage_cache[0] < USAGE_CACHE_TTL_SEC:
+            return self._usage_cache[1]
+        
+        total_bytes = sum(self._dir_size(d) for d in (self.upload_dir, self.output_dir, config.CACHE_DIR))
+        usage_mb = total_bytes / (1024 * 1024)
+        self._usage_cache = (now, usage_mb)
+        return usage_mb
+    
+    def _dir_size(self, path):
+        """Somma ricorsiva delle dimensioni dei file in path."""
+        total = 0
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            total += self._dir_size(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except FileNotFoundError:
+                        continue  # rimosso durante la scansione
+        except FileNotFoundError:
+            pass
+        return total
 
 storage_manager = StorageManager()
\ No newline at end of file
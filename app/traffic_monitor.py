@@ -5,10 +5,19 @@ I dati sono salvati su disco per persistere tra riavvii dell'applicazione.
 """
 
 import os
-import json
 import time
-from datetime import datetime
+import calendar
+import orjson
+from datetime import datetime, timedelta
 from typing import Optional
+from app.logger import logger
+
+def _next_month_start_ts(ts: float) -> float:
+    """Timestamp della mezzanotte del primo giorno del mese successivo a ts (ora locale)."""
+    start = datetime.fromtimestamp(ts)
+    days_in_month = calendar.monthrange(start.year, start.month)[1]
+    first_of_month = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return (first_of_month + timedelta(days=days_in_month)).timestamp()
 
 class TrafficMonitor:
     """
@@ -16,6 +25,11 @@ class TrafficMonitor:
     I dati vengono salvati in un file JSON per persistere tra riavvii.
     """
     
+    # Intervallo minimo tra due salvataggi su disco durante le richieste
+    PERSIST_INTERVAL_SEC = 30
+    # Soglie (%) il cui superamento forza un salvataggio immediato
+    PERSIST_THRESHOLDS = (75, 90, 100)
+    
     def __init__(self, max_gb_per_month: float = 10.0, state_file: str = "traffic_state.json"):
         """
         Inizializza il monitor del traffico.
@@ -28,6 +42,8 @@ class TrafficMonitor:
         self.state_file = state_file
         self.used_bytes = 0
         self.month_start = time.time()
+        self._reset_at = _next_month_start_ts(self.month_start)
+        self._last_persist = 0.0
         self.load_state()
     
     def load_state(self) -> None:
@@ -37,57 +53,63 @@ class TrafficMonitor:
         """
         if os.path.exists(self.state_file):
             try:
-                with open(self.state_file, 'r') as f:
-                    data = json.load(f)
+                with open(self.state_file, 'rb') as f:
+                    data = orjson.loads(f.read())
                     self.used_bytes = data.get('used_bytes', 0)
                     self.month_start = data.get('month_start', time.time())
+                    self._reset_at = _next_month_start_ts(self.month_start)
                     
                     # Verifica se è iniziato un nuovo mese
                     self._check_month_reset()
                     
-                print(f"📊 TrafficMonitor: caricato stato - Usati: {self.used_bytes/(1024**3):.2f}GB, "
-                      f"Mese iniziato: {time.strftime('%Y-%m-%d', time.localtime(self.month_start))}")
+                logger.info("📊 TrafficMonitor: caricato stato - Usati: %.2fGB, Mese iniziato: %s",
+                            self.used_bytes / (1024**3),
+                            time.strftime('%Y-%m-%d', time.localtime(self.month_start)))
             except Exception as e:
-                print(f"⚠️ TrafficMonitor: errore nel caricamento dello stato ({e}), uso valori predefiniti")
+                logger.warning("⚠️ TrafficMonitor: errore nel caricamento dello stato (%s), uso valori predefiniti", e)
                 self._reset_month()
         else:
-            print("📊 TrafficMonitor: nessuno stato precedente trovato, partenza da zero")
+            logger.info("📊 TrafficMonitor: nessuno stato precedente trovato, partenza da zero")
             self._reset_month()
     
     def save_state(self) -> None:
         """
         Salva lo stato corrente su file JSON.
+        La scrittura avviene su un file temporaneo poi rinominato, così un
+        arresto a metà non lascia un file corrotto.
         """
+        tmp_file = f"{self.state_file}.tmp"
         try:
-            with open(self.state_file, 'w') as f:
-                json.dump({
+            with open(tmp_file, 'wb') as f:
+                f.write(orjson.dumps({
                     'used_bytes': self.used_bytes,
                     'month_start': self.month_start,
                     'last_update': time.time()
-                }, f, indent=2)
+                }))
+            os.replace(tmp_file, self.state_file)
+            self._last_persist = time.monotonic()
         except Exception as e:
-            print(f"⚠️ TrafficMonitor: errore nel salvataggio dello stato ({e})")
+            logger.warning("⚠️ TrafficMonitor: errore nel salvataggio dello stato (%s)", e)
     
     def _reset_month(self) -> None:
         """Resetta i contatori per un nuovo mese."""
         self.used_bytes = 0
         self.month_start = time.time()
+        self._reset_at = _next_month_start_ts(self.month_start)
         self.save_state()
-        print(f"🔄 TrafficMonitor: nuovo mese iniziato il {time.strftime('%Y-%m-%d', time.localtime(self.month_start))}")
+        logger.info("🔄 TrafficMonitor: nuovo mese iniziato il %s",
+                    time.strftime('%Y-%m-%d', time.localtime(self.month_start)))
     
     def _check_month_reset(self) -> bool:
         """
-        Verifica se è iniziato un nuovo mese e resetta i contatori se necessario.
+        Verifica se è iniziato un nuovo mese di calendario e resetta i contatori se necessario.
         
         Returns:
             True se è stato fatto un reset, False altrimenti
         """
-        now = time.time()
-        # 30 giorni in secondi (approssimazione di un mese)
-        month_seconds = 30 * 24 * 3600
-        
-        if now - self.month_start > month_seconds:
-            print(f"🔄 TrafficMonitor: reset mensile automatico - Mese precedente: {self.used_bytes/(1024**3):.2f}GB")
+        if time.time() >= self._reset_at:
+            logger.info("🔄 TrafficMonitor: reset mensile automatico - Mese precedente: %.2fGB",
+                        self.used_bytes / (1024**3))
             self._reset_month()
             return True
         return False
@@ -103,18 +125,22 @@ class TrafficMonitor:
         # Verifica reset mensile
         self._check_month_reset()
         
-        # Aggiungi traffico
+        # Aggiungi traffico (reset già verificato: percentuale calcolata direttamente)
+        previous_percent = (self.used_bytes / self.max_bytes) * 100
         self.used_bytes += (upload_bytes + download_bytes)
+        usage_percent = (self.used_bytes / self.max_bytes) * 100
         
-        # Salva stato
-        self.save_state()
+        # Salva stato al massimo ogni PERSIST_INTERVAL_SEC, o subito se si supera una soglia
+        crossed = any(previous_percent < t <= usage_percent for t in self.PERSIST_THRESHOLDS)
+        if crossed or time.monotonic() - self._last_persist > self.PERSIST_INTERVAL_SEC:
+            self.save_state()
         
         # Log di warning se ci avviciniamo al limite
-        usage_percent = self.get_usage_percent()
         if usage_percent > 90:
-            print(f"⚠️ ATTENZIONE: Traffico al {usage_percent:.1f}% del limite mensile ({self.used_bytes/(1024**3):.2f}/{self.max_bytes/(1024**3):.1f}GB)")
+            logger.warning("⚠️ ATTENZIONE: Traffico al %.1f%% del limite mensile (%.2f/%.1fGB)",
+                           usage_percent, self.used_bytes / (1024**3), self.max_bytes / (1024**3))
         elif usage_percent > 75:
-            print(f"📈 Traffico al {usage_percent:.1f}% del limite mensile")
+            logger.info("📈 Traffico al %.1f%% del limite mensile", usage_percent)
     
     def is_limit_reached(self) -> bool:
         """
@@ -1,10 +1,15 @@
 # Pacchetto delle utility
-from app.utils.file_utils import trim_audio, validate_audio_file
-from app.utils.spleeter_utils import separate_stems, create_zip
+from app.utils.file_utils import trim_audio, trim_audio_async, validate_audio_file
+from app.utils.spleeter_utils import separate_stems, create_zip, iter_zip, aiter_zip, stem_files, zip_is_fresh
 
 __all__ = [
     'trim_audio',
+    'trim_audio_async',
     'validate_audio_file',
     'separate_stems',
-    'create_zip'
+    'create_zip',
+    'iter_zip',
+    'aiter_zip',
+    'stem_files',
+    'zip_is_fresh'
 ]
\ No newline at end of file
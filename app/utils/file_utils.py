@@ -1,21 +1,82 @@
+import asyncio
 import subprocess
 import os
+import sys
+from collections import deque
 from fastapi import HTTPException
 
+# Parti fisse del comando ffmpeg, costruite una volta sola all'import
+_FFMPEG_PREFIX = ["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error", "-i"]
+# Il taglio produce già l'ingresso nel formato del modello (WAV 16 bit stereo
+# a 44.1 kHz): master hi-res o multicanale arrivano a Spleeter ridotti.
+# Un solo thread basta e non toglie CPU a Spleeter
+_TRIM_ARGS = ["-ac", "2", "-ar", "44100", "-c:a", "pcm_s16le", "-threads", "1"]
+
+def _trim_cmd(input_path, output_path, max_duration):
+    return _FFMPEG_PREFIX + [input_path, "-t", str(max_duration)] + _TRIM_ARGS + [output_path, "-y"]
+
+def _lower_priority():
+    """Eseguito nel processo figlio prima di ffmpeg: Spleeter ha la precedenza sulla CPU"""
+    os.nice(5)
+
+_FFMPEG_PREEXEC = _lower_priority if sys.platform == "linux" else None
+
+# Di stderr conserviamo solo la coda: serve unicamente per il messaggio d'errore
+STDERR_TAIL_BYTES = 8192
+
+async def _read_tail(stream, max_bytes=STDERR_TAIL_BYTES):
+    """Legge lo stream fino a EOF tenendo in memoria solo gli ultimi max_bytes"""
+    tail = deque(maxlen=max_bytes)
+    while True:
+        chunk = await stream.read(4096)
+        if not chunk:
+            break
+        tail.extend(chunk)
+    return bytes(tail).decode(errors='replace')
+
 def trim_audio(input_path, output_path, max_duration):
     """Taglia file audio con ffmpeg"""
-    cmd = [
-        "ffmpeg", "-i", input_path,
-        "-t", str(max_duration),
-        "-c", "copy", output_path, "-y"
-    ]
+    cmd = _trim_cmd(input_path, output_path, max_duration)
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        result = subprocess.run(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            text=True, timeout=30,
+            preexec_fn=_FFMPEG_PREEXEC
+        )
         if result.returncode != 0:
             raise HTTPException(500, f"FFmpeg error: {result.stderr}")
         return output_path
     except subprocess.TimeoutExpired:
         raise HTTPException(504, "FFmpeg timeout")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(500, str(e))
+
+async def trim_audio_async(input_path, output_path, max_duration):
+    """Taglia file audio con ffmpeg senza bloccare l'event loop"""
+    cmd = _trim_cmd(input_path, output_path, max_duration)
+    proc = None
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            preexec_fn=_FFMPEG_PREEXEC
+        )
+        stderr, _ = await asyncio.wait_for(
+            asyncio.gather(_read_tail(proc.stderr), proc.wait()), timeout=30
+        )
+        if proc.returncode != 0:
+            raise HTTPException(500, f"FFmpeg error: {stderr}")
+        return output_path
+    except asyncio.TimeoutError:
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise HTTPException(504, "FFmpeg timeout")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, str(e))
 
@@ -24,4 +85,4 @@ def validate_audio_file(filename: str):
     allowed = ('.mp3', '.wav', '.m4a', '.aac', '.flac', '.ogg')
     if not filename.lower().endswith(allowed):
         raise HTTPException(400, f"Formato non supportato. Usa: {allowed}")
-    return True
\ No newline at end of file
+    return True
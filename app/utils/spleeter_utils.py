@@ -1,38 +1,193 @@
-import subprocess
+import asyncio
+import io
 import os
-import shutil
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import HTTPException
 from app.config import config
+from app.spleeter_pool import run_separation
+from app.stem_cache import stem_cache, TMP_SUFFIX
 
-def separate_stems(input_path, output_folder, file_id):
-    """Esegue Spleeter con modello configurato"""
-    cmd = [
-        "spleeter", "separate",
-        "-p", config.SPLEETER_MODEL,
-        "-o", output_folder,
-        input_path
-    ]
-    
+# Separazioni in corso per hash del contenuto: chi carica lo stesso audio mentre
+# è già in lavorazione attende quella separazione invece di rieseguirla
+_inflight = {}
+
+async def separate_stems(input_path, output_folder, file_id):
+    """
+    Esegue Spleeter con modello configurato su un worker del pool.
+    Se lo stesso audio è già stato separato restituisce gli stems dalla cache;
+    se è in separazione per un'altra richiesta ne attende il risultato.
+    La cartella restituita appartiene alla cache e non va eliminata dal chiamante.
+    """
+    loop = asyncio.get_running_loop()
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
-        if result.returncode != 0:
-            raise Exception(f"Spleeter error: {result.stderr}")
-        
-        # Trova la cartella generata
-        base_name = os.path.splitext(os.path.basename(input_path))[0]
-        stem_folder = os.path.join(output_folder, base_name)
-        
-        if not os.path.exists(stem_folder):
-            raise Exception("Stem folder not found")
+        key = await loop.run_in_executor(None, stem_cache.hash_file, input_path)
+        while True:
+            cached = stem_cache.get(key)
+            if cached is not None:
+                return cached
+            event = _inflight.get(key)
+            if event is None:
+                break
+            # Se la prima richiesta fallisce la cache resta vuota e si riprova qui
+            await event.wait()
         
-        return stem_folder
+        event = _inflight[key] = asyncio.Event()
+        try:
+            stem_folder = await run_separation(input_path, output_folder, timeout=120)
+            return await loop.run_in_executor(None, stem_cache.put, key, stem_folder)
+        finally:
+            del _inflight[key]
+            event.set()
         
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         raise HTTPException(504, "Spleeter timeout")
     except Exception as e:
         raise HTTPException(500, str(e))
 
+# Formati già compressi: nello zip vengono sempre solo archiviati
+_COMPRESSED_AUDIO_EXT = ('.mp3', '.ogg', '.m4a', '.flac')
+
+def _zip_compression(name):
+    """(compress_type, compresslevel) per uno stem nello zip."""
+    if config.ZIP_DEFLATE_WAV and not name.lower().endswith(_COMPRESSED_AUDIO_EXT):
+        return zipfile.ZIP_DEFLATED, 1
+    return zipfile.ZIP_STORED, None
+
+# Dimensione dei blocchi letti dagli stems durante lo streaming dello zip (1 MB)
+ZIP_STREAM_CHUNK_SIZE = 1 << 20
+
+# Thread dedicati alla generazione degli zip: lo zip di una richiesta procede
+# mentre i worker Spleeter lavorano già sulla successiva
+_ZIP_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="zip")
+
+def _list_stems(stem_folder, stems=None):
+    """
+    Lista (path, nome file, mtime) dei file nella cartella degli stems.
+    stems filtra per nome dello stem senza estensione (es. "vocals"); None = tutti.
+    """
+    stems = stems or None  # selezione vuota: tutti gli stems
+    with os.scandir(stem_folder) as it:
+        entries = [(entry.path, entry.name, entry.stat().st_mtime) for entry in it if entry.is_file()]
+    if stems is not None:
+        entries = [e for e in entries if e[1].rpartition('.')[0] in stems]
+    return entries
+
+def stem_files(stem_folder):
+    """Dizionario nome stem -> path del file (es. {"vocals": ".../vocals.wav"})."""
+    return {name.rpartition('.')[0]: path for path, name, _ in _list_stems(stem_folder)}
+
+def _is_fresh(zip_path, stems):
+    try:
+        return os.path.getmtime(zip_path) >= max((mtime for _, _, mtime in stems), default=0)
+    except FileNotFoundError:
+        return False
+
+def zip_is_fresh(stem_folder, zip_path):
+    """True se zip_path esiste ed è più recente di tutti gli stems."""
+    return _is_fresh(zip_path, _list_stems(stem_folder))
+
 def create_zip(stem_folder, zip_path):
-    """Crea zip dagli stems"""
-    shutil.make_archive(zip_path.replace('.zip', ''), 'zip', stem_folder)
-    return zip_path
\ No newline at end of file
+    """
+    Crea zip con tutti gli stems (audio compresso solo archiviato, WAV deflate veloce se abilitato).
+    Se zip_path esiste ed è più recente degli stems viene riusato così com'è.
+    Per una selezione di stems usare iter_zip: zip_path è lo zip completo in cache.
+    """
+    stems = _list_stems(stem_folder)
+    if _is_fresh(zip_path, stems):
+        return zip_path
+    
+    # Scrittura su file temporaneo: richieste parallele sullo stesso zip non lo corrompono
+    tmp_path = f"{zip_path}.{uuid.uuid4().hex}{TMP_SUFFIX}"
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for path, name, _ in stems:
+                compress_type, compresslevel = _zip_compression(name)
+                zf.write(path, name, compress_type=compress_type, compresslevel=compresslevel)
+        os.replace(tmp_path, zip_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return zip_path
+
+class _ZipStreamBuffer(io.RawIOBase):
+    """Destinazione non posizionabile per ZipFile: accumula i byte finché non vengono letti."""
+    
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def iter_zip(stem_folder, tee_path=None, stems=None):
+    """
+    Genera lo zip degli stems a blocchi, senza materializzarlo prima su disco.
+    Se tee_path è indicato, gli stessi byte vengono scritti anche lì (rinominato
+    solo a zip completo), così la risposta popola la cache senza una seconda lettura.
+    stems limita lo zip agli stems indicati (None = tutti).
+    """
+    stems = _list_stems(stem_folder, stems)
+    buffer = _ZipStreamBuffer()
+    tmp_path = f"{tee_path}.{uuid.uuid4().hex}{TMP_SUFFIX}" if tee_path else None
+    tee = open(tmp_path, 'wb') if tmp_path else None
+    completed = False
+    
+    def flush():
+        data = buffer.drain()
+        if data:
+            if tee is not None:
+                tee.write(data)
+            yield data
+    
+    try:
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for path, name, _ in stems:
+                # ZipInfo dal file: mantiene la data di modifica dello stem
+                zinfo = zipfile.ZipInfo.from_file(path, name)
+                zinfo.compress_type, zinfo._compresslevel = _zip_compression(name)
+                with open(path, 'rb') as src, zf.open(zinfo, 'w') as dst:
+                    for chunk in iter(lambda: src.read(ZIP_STREAM_CHUNK_SIZE), b''):
+                        dst.write(chunk)
+                        yield from flush()
+                yield from flush()
+        # Central directory scritta alla chiusura dello ZipFile
+        yield from flush()
+        completed = True
+    finally:
+        if tee is not None:
+            tee.close()
+            if completed:
+                os.replace(tmp_path, tee_path)
+            else:
+                os.remove(tmp_path)
+
+async def aiter_zip(stem_folder, tee_path=None, stems=None):
+    """Come iter_zip, ma ogni blocco viene prodotto su _ZIP_POOL senza bloccare l'event loop."""
+    chunks = iter_zip(stem_folder, tee_path, stems)
+    pending = None
+    try:
+        while True:
+            pending = _ZIP_POOL.submit(next, chunks, None)
+            chunk = await asyncio.wrap_future(pending)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        # Client disconnesso: il generatore (e il tee) va chiuso solo dopo
+        # l'eventuale next() ancora in esecuzione nel pool
+        if pending is None:
+            chunks.close()
+        else:
+            pending.add_done_callback(lambda _: chunks.close())